@@ -1,72 +1,329 @@
 from dotenv import load_dotenv
 from pydantic import BaseModel
 
+import asyncio
+import os
 import uvicorn
 import json
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 
+try:
+    from fastapi.sse import EventSourceResponse, ServerSentEvent
+except ImportError:  # FastAPI < 0.135 has no native SSE support
+    EventSourceResponse = ServerSentEvent = None
+
 from langchain.agents import create_agent
-from langchain.tools import tool
-from langchain.messages import SystemMessage, HumanMessage
+from langchain.agents.middleware import AgentMiddleware
+from langchain.tools import tool, BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 from google.genai import errors as genai_errors
 
 import yfinance as yf
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache, cached
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import atexit
+import sqlite3
 import base64
 from io import BytesIO
-import matplotlib
-
-matplotlib.use('Agg')  # Headless rendering for server environments
-import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
 load_dotenv() 
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The SQLite checkpointer is bound to the running event loop, so the agent is built here
+    global checkpointer, agent
+    async with AsyncSqliteSaver.from_conn_string('checkpoints.db') as saver:
+        checkpointer = saver
+        await setup_checkpointer()
+        agent = build_agent(checkpointer)
+        pruner = asyncio.create_task(prune_idle_threads_forever())
+        yield
+        pruner.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # --- UPDATED MODEL SETUP ---
 model = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash-lite", 
-    temperature=0
+    temperature=0,
+    max_output_tokens=1024,  # bound runaway generations on long tool-heavy answers
+    timeout=30,
+    max_retries=1,  # fail fast to the quota/client-error message instead of stalling the stream
+    streaming=True
 )
 
-checkpointer = InMemorySaver()
+# --- CONVERSATION STATE ---
+# Checkpoints live in SQLite so memory stays bounded and threads survive restarts. Threads idle
+# for longer than THREAD_TTL_SECONDS are deleted by a background task every PRUNE_INTERVAL_SECONDS.
+THREAD_TTL_SECONDS = 3600
+PRUNE_INTERVAL_SECONDS = 600
+
+checkpointer = None  # AsyncSqliteSaver, opened in lifespan()
+
+
+async def setup_checkpointer():
+    await checkpointer.setup()
+    async with checkpointer.lock:
+        await checkpointer.conn.execute(
+            'CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)'
+        )
+        await checkpointer.conn.commit()
+
+
+async def touch_thread(thread_id: str):
+    async with checkpointer.lock:
+        await checkpointer.conn.execute(
+            'INSERT INTO thread_activity (thread_id, last_seen) VALUES (?, ?) '
+            'ON CONFLICT(thread_id) DO UPDATE SET last_seen = excluded.last_seen',
+            (thread_id, time.time())
+        )
+        await checkpointer.conn.commit()
+
+
+async def prune_idle_threads():
+    cutoff = time.time() - THREAD_TTL_SECONDS
+    async with checkpointer.lock:
+        async with checkpointer.conn.execute(
+            'SELECT thread_id FROM thread_activity WHERE last_seen < ?', (cutoff,)
+        ) as cursor:
+            stale = [row[0] for row in await cursor.fetchall()]
+
+    for thread_id in stale:
+        await checkpointer.adelete_thread(thread_id)
+
+    async with checkpointer.lock:
+        await checkpointer.conn.execute('DELETE FROM thread_activity WHERE last_seen < ?', (cutoff,))
+        await checkpointer.conn.commit()
+
+
+async def prune_idle_threads_forever():
+    while True:
+        await asyncio.sleep(PRUNE_INTERVAL_SECONDS)
+        try:
+            await prune_idle_threads()
+        except Exception as err:  # keep pruning on the next tick rather than killing the task
+            print(f'Checkpoint pruning failed: {err}')
+
+# --- YFINANCE SESSION ---
+def _build_yf_session():
+    # yfinance >= 0.2.54 only accepts curl_cffi sessions; older releases take any requests.Session
+    try:
+        from curl_cffi import requests as curl_requests
+        return curl_requests.Session(impersonate='chrome')
+    except ImportError:
+        pass
+
+    try:
+        from requests_cache import CachedSession
+        session = CachedSession('yfinance.cache', expire_after=300)
+    except ImportError:
+        session = requests.Session()
+
+    # Keep TLS connections to Yahoo alive across tool calls and retry transient failures
+    session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                          max_retries=Retry(total=2, backoff_factor=0.3)))
+    return session
+
+
+yf_session = _build_yf_session()
+
+# --- YFINANCE CACHES ---
+# Quotes move quickly, fundamentals and news do not. Ticker objects memoize their own
+# info/fast_info, so caching the object for a minute also caches those lookups.
+_price_cache = TTLCache(maxsize=512, ttl=60)
+_history_cache = TTLCache(maxsize=512, ttl=60)
+_bulk_history_cache = TTLCache(maxsize=256, ttl=60)
+_fundamentals_cache = TTLCache(maxsize=512, ttl=3600)
+_news_cache = TTLCache(maxsize=256, ttl=900)
+
+
+# --- DOWNSAMPLING ---
+# Long histories are thinned before they are drawn or handed to the model
+CHART_MAX_POINTS = 300
+HISTORY_MAX_ROWS = 500
+
+
+def _lttb_indices(x, y, n_out: int):
+    # Largest-Triangle-Three-Buckets: keep the n_out points that best preserve the shape of (x, y)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (n_out - 2)
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def _normalize_symbol(ticker: str) -> str:
+    return (ticker or '').strip().upper()
+
+
+@cached(_price_cache, lock=Lock())
+def _get_ticker(symbol: str):
+    return yf.Ticker(symbol, session=yf_session)
+
+
+@cached(_history_cache, lock=Lock())
+def _get_history(symbol: str, **kwargs):
+    # Shared frame between callers: treat the result as read-only
+    return _get_ticker(symbol).history(**kwargs)
+
+
+@cached(_bulk_history_cache, lock=Lock())
+def _get_bulk_history(symbols: tuple[str, ...], start: str, end: str, interval: str = '1d'):
+    # One yf.download call fetches every symbol concurrently; split the result back out per symbol.
+    # Shared frames between callers: treat the results as read-only
+    frame = yf.download(list(symbols), start=start, end=end, interval=interval, group_by='ticker',
+                        auto_adjust=True, actions=True, threads=True, progress=False, session=yf_session)
+    if frame is None or frame.empty:
+        return {}
+
+    fetched = set(frame.columns.get_level_values(0))
+    histories = {s: frame[s].dropna(how='all') for s in symbols if s in fetched}
+    return {s: history for s, history in histories.items() if not history.empty}
+
+
+@cached(_fundamentals_cache, lock=Lock())
+def _get_balance_sheet(symbol: str):
+    return _get_ticker(symbol).balance_sheet
+
+
+def _parse_news_item(item) -> tuple:
+    # items from yfinance may be nested (e.g., {'content': {...}}) or flat
+    entry = item.get('content') if isinstance(item, dict) and item.get('content') else item
+
+    if not isinstance(entry, dict):  # fallback for non-dict entries
+        title = entry if isinstance(entry, str) and entry else 'No title'
+        return '', title, 'Unknown source', None
+
+    title = entry.get('title') or entry.get('summary') or entry.get('description') or 'No title'
+    # provider could be nested under 'provider' or 'provider.displayName'
+    provider = entry.get('provider') or entry.get('publisher') or entry.get('source')
+    if isinstance(provider, dict):
+        provider = provider.get('displayName') or provider.get('name')
+    time = entry.get('displayTime') or entry.get('pubDate') or ''
+    # canonicalUrl may be nested
+    url = entry.get('canonicalUrl') or entry.get('clickThroughUrl')
+    if isinstance(url, dict):
+        url = url.get('url')
+
+    return time, title, provider or 'Unknown source', url
+
+
+@cached(_news_cache, lock=Lock())
+def _get_news_items(symbol: str) -> tuple:
+    # News refreshes on the order of minutes, so the top 5 items are parsed once per cache window
+    return tuple(_parse_news_item(item) for item in (_get_ticker(symbol).news or [])[:5])
+
+
+# --- COMPANY NAMES ---
+# Ticker.info is the slowest Yahoo endpoint and quotes only need it for a display name, so
+# names live on disk and are filled in the background; a quote never waits on info.
+# SQLite (unlike dbm/shelve) can be shared safely by several server worker processes.
+_NAME_DB = sqlite3.connect('ticker_names.sqlite', check_same_thread=False)
+atexit.register(_NAME_DB.close)
+_name_lock = Lock()
+_name_pending = set()
+_name_executor = ThreadPoolExecutor(max_workers=2)
+
+with _name_lock:
+    _NAME_DB.execute('CREATE TABLE IF NOT EXISTS ticker_names (symbol TEXT PRIMARY KEY, name TEXT, fetched TEXT NOT NULL)')
+    _NAME_DB.executemany(
+        'INSERT OR IGNORE INTO ticker_names (symbol, name, fetched) VALUES (?, ?, ?)',
+        [(symbol, name, date.today().isoformat())
+         for symbol, name in {'SPY': 'SPDR S&P 500 ETF Trust', 'DAX': 'Global X DAX Germany ETF'}.items()]
+    )
+    _NAME_DB.commit()
+
+
+def _fetch_company_name(symbol: str):
+    try:
+        info = _get_ticker(symbol).info or {}
+        name = info.get('shortName') or info.get('longName')
+    except Exception:
+        name = None
+
+    with _name_lock:
+        _NAME_DB.execute('INSERT OR REPLACE INTO ticker_names (symbol, name, fetched) VALUES (?, ?, ?)',
+                         (symbol, name, date.today().isoformat()))
+        _NAME_DB.commit()
+        _name_pending.discard(symbol)
+
+
+def _get_company_name(symbol: str):
+    # Unknown names are looked up at most once per symbol per day
+    today = date.today().isoformat()
+    with _name_lock:
+        row = _NAME_DB.execute('SELECT name, fetched FROM ticker_names WHERE symbol = ?', (symbol,)).fetchone()
+        name, fetched = row or (None, None)
+        if name is None and fetched != today and symbol not in _name_pending:
+            _name_pending.add(symbol)
+            _name_executor.submit(_fetch_company_name, symbol)
+    return name
+
+
+def _split_symbols(tickers) -> list[str]:
+    # Accept a list or a comma/space separated string; drop blanks and duplicates
+    if isinstance(tickers, str):
+        tickers = tickers.replace(',', ' ').split()
+    symbols = (_normalize_symbol(t) for t in tickers)
+    return list(dict.fromkeys(s for s in symbols if s))
+
+
+async def _gather_symbols(fn, symbols: list[str]) -> list:
+    # yfinance is blocking, so run one lookup per symbol on a worker thread and await them together
+    return await asyncio.gather(*(asyncio.to_thread(fn, symbol) for symbol in symbols))
 
-@tool('get_stock_price', description='A function that returns the current stock price based on a ticker symbol.')
-def get_stock_price(ticker: str):
-    print('get_stock_price tool is being used')
-    stock = yf.Ticker(ticker)
 
-    # Try to retrieve the latest close price robustly
+def _describe_price(symbol: str) -> str:
+    stock = _get_ticker(symbol)
+
+    # fast_info is a single cheap quote call; try it before downloading any price history
     price = None
     try:
-        hist = stock.history()
-        if not hist.empty:
-            price = hist['Close'].iloc[-1]
+        fast = getattr(stock, 'fast_info', None)
+        if fast is not None:
+            price = fast.get('last_price')
     except Exception:
         price = None
 
-    # Fallback to fast_info or info
+    # Fallback to the latest intraday close
     if price is None:
         try:
-            fast = getattr(stock, 'fast_info', None)
-            if fast and isinstance(fast, dict):
-                price = fast.get('last_price') or fast.get('last_close')
+            hist = _get_history(symbol, period='1d', interval='1m')
+            if not hist.empty:
+                price = hist['Close'].iloc[-1]
         except Exception:
             price = None
 
-    # Get a readable company name if available
-    name = None
-    try:
-        info = getattr(stock, 'info', {}) or {}
-        name = info.get('shortName') or info.get('longName')
-    except Exception:
-        name = None
-
-    symbol = (ticker or '').upper()
+    # Get a readable company name if one is already known
+    name = _get_company_name(symbol)
 
     if price is None:
         return f'No price data available for {symbol}.'
@@ -82,68 +339,88 @@ def get_stock_price(ticker: str):
     return f'The current stock price of {symbol} is {formatted}.'
 
 
+async def _describe_prices(symbols: list[str]) -> str:
+    if not symbols:
+        return 'No ticker symbols provided.'
+    return '\n'.join(await _gather_symbols(_describe_price, symbols))
+
+
+@tool('get_stock_price', description='A function that returns the current stock price based on a ticker symbol.')
+async def get_stock_price(ticker: str):
+    print('get_stock_price tool is being used')
+    if ',' in ticker:
+        return await _describe_prices(_split_symbols(ticker))
+    return await asyncio.to_thread(_describe_price, _normalize_symbol(ticker))
+
+
+@tool('get_stock_prices_batch', description='A function that returns the current stock prices for a list of ticker symbols in one call.')
+async def get_stock_prices_batch(tickers: list[str]):
+    print('get_stock_prices_batch tool is being used')
+    return await _describe_prices(_split_symbols(tickers))
+
+
+def _history_csv(history) -> str:
+    if len(history) > HISTORY_MAX_ROWS:
+        x = history.index.asi8.astype(float)
+        history = history.iloc[_lttb_indices(x, history['Close'].to_numpy(dtype=float), CHART_MAX_POINTS)]
+
+    # Compact CSV costs the model far fewer tokens than a dict of Timestamp-keyed columns
+    return history.to_csv(index_label='Date', date_format='%Y-%m-%d', float_format='%.2f')
+
+
+async def _describe_histories(symbols: list[str], start_date: str, end_date: str) -> dict:
+    if not symbols:
+        return {}
+    histories = await asyncio.to_thread(_get_bulk_history, tuple(symbols), start_date, end_date)
+    return {
+        symbol: _history_csv(histories[symbol]) if symbol in histories else f'No price data available for {symbol}.'
+        for symbol in symbols
+    }
+
+
+def _join_histories(histories: dict) -> str:
+    return '\n'.join(f'{symbol}:\n{history}' for symbol, history in histories.items())
+
+
 @tool('get_historical_stock_price', description='A function that returns the current stock price over time based on a ticker symbol and a start and end date.')
-def get_historical_stock_price(ticker: str, start_date: str, end_date: str):
+async def get_historical_stock_price(ticker: str, start_date: str, end_date: str):
     print('get_historical_stock_price tool is being used')
-    stock = yf.Ticker(ticker)
-    return stock.history(start=start_date, end=end_date).to_dict()
+    if ',' in ticker:
+        return _join_histories(await _describe_histories(_split_symbols(ticker), start_date, end_date))
+    symbol = _normalize_symbol(ticker)
+    return (await _describe_histories([symbol], start_date, end_date))[symbol]
+
+
+@tool('get_historical_stock_prices_batch', description='A function that returns the stock prices over time for a list of ticker symbols and a start and end date, as CSV per symbol.')
+async def get_historical_stock_prices_batch(tickers: list[str], start_date: str, end_date: str):
+    print('get_historical_stock_prices_batch tool is being used')
+    symbols = _split_symbols(tickers)
+    if not symbols:
+        return 'No ticker symbols provided.'
+    return _join_histories(await _describe_histories(symbols, start_date, end_date))
 
 
 @tool('get_balance_sheet', description='A function that returns the balance sheet based on a ticker symbol.')
-def get_balance_sheet(ticker: str):
+async def get_balance_sheet(ticker: str):
     print('get_balance_sheet tool is being used')
-    stock = yf.Ticker(ticker)
-    return stock.balance_sheet
+    if ',' in ticker:
+        symbols = _split_symbols(ticker)
+        return dict(zip(symbols, await _gather_symbols(_get_balance_sheet, symbols)))
+    return await asyncio.to_thread(_get_balance_sheet, _normalize_symbol(ticker))
 
 
 @tool('get_stock_news', description='A function that returns news based on a ticker symbol.')
-def get_stock_news(ticker: str):
+async def get_stock_news(ticker: str):
     print('get_stock_news tool is being used')
-    stock = yf.Ticker(ticker)
-    raw = stock.news
-
-    if not raw:
-        return f'No recent news found for {ticker.upper()}.'
-
-    # Normalize and build a concise, user-friendly summary (top 5 items)
-    items = raw[:5]
-    lines = [f'Here are the latest updates for {ticker.upper()}:']
-
-    for it in items:
-        # items from yfinance may be nested (e.g., {'content': {...}}) or flat
-        entry = it.get('content') if isinstance(it, dict) and it.get('content') else it
-
-        title = None
-        provider = None
-        time = None
-        url = None
-
-        if isinstance(entry, dict):
-            title = entry.get('title') or entry.get('summary') or entry.get('description')
-            provider = None
-            # provider could be nested under 'provider' or 'provider.displayName'
-            prov = entry.get('provider') or entry.get('publisher') or entry.get('source')
-            if isinstance(prov, dict):
-                provider = prov.get('displayName') or prov.get('name')
-            else:
-                provider = prov
-
-            time = entry.get('displayTime') or entry.get('pubDate')
-            # canonicalUrl may be nested
-            can = entry.get('canonicalUrl') or entry.get('clickThroughUrl')
-            if isinstance(can, dict):
-                url = can.get('url')
-            else:
-                url = can
-
-        # Fallback for non-dict entries
-        title = title or (entry if isinstance(entry, str) else None) or 'No title'
-        provider = provider or 'Unknown source'
-        time = time or ''
-
-        # Shorten time for readability (keep as-is if not present)
-        time_str = f"[{time}] " if time else ''
+    symbol = _normalize_symbol(ticker)
+    items = await asyncio.to_thread(_get_news_items, symbol)
 
+    if not items:
+        return f'No recent news found for {symbol}.'
+
+    lines = [f'Here are the latest updates for {symbol}:']
+    for time, title, provider, url in items:
+        time_str = f'[{time}] ' if time else ''
         if url:
             lines.append(f'- {time_str}{title} ({provider}) — {url}')
         else:
@@ -151,41 +428,133 @@ def get_stock_news(ticker: str):
 
     return '\n'.join(lines)
 
+# --- CHART RENDERING ---
+# Charts are a single polyline, so they are rasterized directly with Pillow instead of going
+# through a full plotting pipeline
+_CHART_SIZE = (800, 300)
+_CHART_MARGIN = (64, 28, 16, 24)  # left, top, right, bottom
+_CHART_BACKGROUND = (4, 10, 18)
+_CHART_LINE = (74, 243, 195)
+_CHART_TITLE = (233, 240, 248)
+_CHART_LABEL = (151, 167, 195)
+_CHART_GRID = (28, 37, 50)
+_CHART_FONT = ImageFont.load_default()
+_chart_cache = TTLCache(maxsize=128, ttl=300)
+
+
+@cached(_chart_cache, lock=Lock())
+def _render_chart(symbol: str, period: str, interval: str):
+    closes = _get_history(symbol, period=period, interval=interval)['Close'].dropna()
+
+    if closes.empty:
+        return None
+
+    width, height = _CHART_SIZE
+    left, top, right, bottom = _CHART_MARGIN
+    plot_width = width - left - right
+    plot_height = height - top - bottom
+
+    low, high = float(closes.min()), float(closes.max())
+    span = (high - low) or 1.0
+    step = plot_width / max(len(closes) - 1, 1)
+    values = closes.to_numpy(dtype=float)
+    positions = _lttb_indices(np.arange(len(values), dtype=float), values, CHART_MAX_POINTS)
+    points = [(left + i * step, top + (high - values[i]) / span * plot_height) for i in positions.tolist()]
+
+    image = Image.new('RGB', _CHART_SIZE, _CHART_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    # Horizontal grid lines labelled with prices
+    for i in range(5):
+        y = top + i * plot_height / 4
+        draw.line([(left, y), (width - right, y)], fill=_CHART_GRID)
+        draw.text((4, y - 5), f'{high - i * span / 4:,.2f}', fill=_CHART_LABEL, font=_CHART_FONT)
+
+    draw.text((left, 8), f'{symbol} close price (USD)', fill=_CHART_TITLE, font=_CHART_FONT)
+    draw.text((left, height - bottom + 8), f'{closes.index[0]:%Y-%m-%d}', fill=_CHART_LABEL, font=_CHART_FONT)
+    end_label = f'{closes.index[-1]:%Y-%m-%d}'
+    draw.text((width - right - draw.textlength(end_label, font=_CHART_FONT), height - bottom + 8),
+              end_label, fill=_CHART_LABEL, font=_CHART_FONT)
+
+    if len(points) > 1:
+        draw.line(points, fill=_CHART_LINE, width=2, joint='curve')
+    else:
+        x, y = points[0]
+        draw.ellipse([(x - 2, y - 2), (x + 2, y + 2)], fill=_CHART_LINE)
+
+    buffer = BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)  # favour encode speed over a few extra bytes
+
+    # Encode straight from the buffer's memory rather than copying it out with read()
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getbuffer()).decode('ascii')
+
+
 @tool('render_stock_chart', description='Render a price chart for a ticker over a given period. Returns a data URI (PNG).')
-def render_stock_chart(ticker: str, period: str = '6mo', interval: str = '1d'):
+async def render_stock_chart(ticker: str, period: str = '6mo', interval: str = '1d'):
     print('render_stock_chart tool is being used')
-    history = yf.Ticker(ticker).history(period=period, interval=interval)
+    chart = await asyncio.to_thread(_render_chart, _normalize_symbol(ticker), period, interval)
 
-    if history.empty:
+    if chart is None:
         return f'No price data available for {ticker}.'
+    return chart
+
+SYSTEM_PROMPT = (
+    'You are a stock analysis assistant. You can stream answers, fetch real-time stock '
+    'prices, historical prices (with date range), news, balance sheet data, and also '
+    'render quick PNG price charts via the render_stock_chart tool. Charts returned by '
+    'render_stock_chart are shown to the user automatically, so never repeat the data URI '
+    'in your answer; just describe what the chart shows. When a question needs several '
+    'tickers or several kinds of data, request all of the independent tool calls in the same '
+    'turn (or use the *_batch tools) instead of one call per turn, so they run in parallel.'
+)
 
-    fig, ax = plt.subplots(figsize=(8, 3))
-    ax.plot(history.index, history['Close'], color='#4af3c3', linewidth=2)
-    ax.set_title(f'{ticker.upper()} close price', color='#e9f0f8')
-    ax.set_ylabel('Price (USD)', color='#97a7c3')
-    ax.grid(alpha=0.2)
-    ax.tick_params(colors='#97a7c3')
-    fig.tight_layout()
 
-    buffer = BytesIO()
-    fig.savefig(buffer, format='png', dpi=160, bbox_inches='tight', facecolor='#040a12')
-    plt.close(fig)
-    buffer.seek(0)
-
-    encoded = base64.b64encode(buffer.read()).decode('utf-8')
-    return f'data:image/png;base64,{encoded}'
-
-agent = create_agent(
-    model = model,
-    checkpointer = checkpointer,
-    tools = [
-        get_stock_price,
-        get_historical_stock_price,
-        get_balance_sheet,
-        get_stock_news,
-        render_stock_chart
-    ]
-)
+TOOLS = [
+    get_stock_price,
+    get_stock_prices_batch,
+    get_historical_stock_price,
+    get_historical_stock_prices_batch,
+    get_balance_sheet,
+    get_stock_news,
+    render_stock_chart
+]
+
+
+class PrecompiledToolSchemas(AgentMiddleware):
+    # create_agent calls model.bind_tools on every model call, which regenerates each tool's
+    # JSON schema. Convert the tools once here and hand the model the ready-made schemas; the
+    # tool node still executes the original tools.
+    def __init__(self, tools: list[BaseTool]):
+        super().__init__()
+        self.schemas = {t.name: convert_to_openai_tool(t) for t in tools}
+
+    def _with_schemas(self, request):
+        return request.override(tools=[
+            self.schemas.get(t.name, t) if isinstance(t, BaseTool) else t for t in request.tools
+        ])
+
+    def wrap_model_call(self, request, handler):
+        return handler(self._with_schemas(request))
+
+    async def awrap_model_call(self, request, handler):
+        return await handler(self._with_schemas(request))
+
+
+tool_schemas = PrecompiledToolSchemas(TOOLS)
+
+
+def build_agent(checkpointer):
+    # The system prompt is part of the graph, so it is not appended to the thread history every turn
+    return create_agent(
+        model = model,
+        system_prompt = SYSTEM_PROMPT,
+        checkpointer = checkpointer,
+        tools = TOOLS,
+        middleware = [tool_schemas]
+    )
+
+
+agent = None  # built in lifespan() once the checkpointer is open
 
 class PromptObject(BaseModel):
     content: str
@@ -199,39 +568,57 @@ class RequestObject(BaseModel):
     responseId: str
 
 
-@app.post('/api/chat')
-async def chat(request: RequestObject):
+async def stream_chat(request: RequestObject):
+    # Yield the agent's reply as JSON-ready event payloads: tokens, then an error (if any), then done
     config = {'configurable': {'thread_id': request.threadId}}
 
-    def generate():
-        try:
-            for token, _ in agent.stream(
-                {'messages': [
-                    SystemMessage(
-                        'You are a stock analysis assistant. You can stream answers, fetch real-time stock '
-                        'prices, historical prices (with date range), news, balance sheet data, and also '
-                        'render quick PNG price charts via the render_stock_chart tool. If you return a '
-                        'data URI image, present it as markdown so the client can display the chart.'
-                    ),
-                    HumanMessage(request.prompt.content)
-                ]},
-                stream_mode='messages',
-                config=config
-            ):
-                yield token.content
-        except genai_errors.ClientError as err:
-            if getattr(err, 'code', None) == 429 or 'quota' in str(err).lower():
-                yield '⚠️ Model quota exhausted. Please retry shortly or upgrade your plan.'
-            else:
-                yield f'⚠️ Upstream client error: {err}'
-        except Exception as err:  # fallback to avoid crashing the SSE stream
-            yield f'⚠️ Unexpected server error: {err}'
-
-    return StreamingResponse(generate(), media_type='text/event-stream',
-                             headers={
-                                 'Cache-Control': 'no-cache, no-transform',
-                                 'Connection': 'keep-alive',
-                             })
+    try:
+        await touch_thread(request.threadId)
+        async for token, _ in agent.astream(
+            {'messages': [HumanMessage(request.prompt.content)]},
+            stream_mode='messages',
+            config=config
+        ):
+            yield {'token': token.content}
+            await asyncio.sleep(0)  # give the loop a tick to flush the chunk to the client
+    except genai_errors.ClientError as err:
+        if getattr(err, 'code', None) == 429 or 'quota' in str(err).lower():
+            yield {'error': '⚠️ Model quota exhausted. Please retry shortly or upgrade your plan.'}
+        else:
+            yield {'error': f'⚠️ Upstream client error: {err}'}
+    except Exception as err:  # fallback to avoid crashing the SSE stream
+        yield {'error': f'⚠️ Unexpected server error: {err}'}
+
+    yield {'done': True}
+
+
+if EventSourceResponse is not None:
+    # Native SSE: FastAPI handles framing, keep-alive pings and the no-buffering headers
+    @app.post('/api/chat', response_class=EventSourceResponse)
+    async def chat(request: RequestObject):
+        async for payload in stream_chat(request):
+            yield ServerSentEvent(data=payload, event='error' if 'error' in payload else None)
+else:
+    def sse_event(payload: dict) -> str:
+        # Frame a JSON payload as a single server-sent event
+        return f'data: {json.dumps(payload)}\n\n'
+
+    @app.post('/api/chat')
+    async def chat(request: RequestObject):
+        async def generate():
+            async for payload in stream_chat(request):
+                yield sse_event(payload)
+
+        return StreamingResponse(generate(), media_type='text/event-stream',
+                                 headers={
+                                     'Cache-Control': 'no-cache, no-transform',
+                                     'Connection': 'keep-alive',
+                                     'X-Accel-Buffering': 'no',  # stop Nginx/CDNs from buffering the stream
+                                 })
 
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=8888)
\ No newline at end of file
+    # 'auto' picks uvloop and httptools when installed (not available on Windows). Conversation
+    # state is in SQLite, so several worker processes can serve the same threads.
+    uvicorn.run('app:app', host='0.0.0.0', port=8888, loop='auto', http='auto',
+                workers=int(os.getenv('WEB_CONCURRENCY', min(4, os.cpu_count() or 1))),
+                lifespan='on', log_level='warning')
\ No newline at end of file
@@ -27,6 +27,29 @@ const highlightTickers = [
   { symbol: 'NVDA', change: '+2.61%', mood: 'momentum' }
 ]
 
+type StreamEvent = {
+  token?: string
+  error?: string
+  done?: boolean
+}
+
+// Split buffered SSE text into complete events, returning any trailing partial event
+const parseStreamEvents = (buffer: string): [StreamEvent[], string] => {
+  const frames = buffer.split('\n\n')
+  const rest = frames.pop() ?? ''
+  const events = frames
+    .map((frame) =>
+      frame
+        .split('\n')
+        .filter((line) => line.startsWith('data:'))
+        .map((line) => line.slice(5).trimStart())
+        .join('\n')
+    )
+    .filter(Boolean)
+    .map((data) => JSON.parse(data) as StreamEvent)
+  return [events, rest]
+}
+
 const renderMessageContent = (content: string) => {
   const imageMatches = content.match(/data:image[^)\s]+/g) ?? []
   const uniqueImages = Array.from(new Set(imageMatches))
@@ -139,13 +162,26 @@ function App() {
 
       const reader = response.body.getReader()
       const decoder = new TextDecoder()
+      let buffer = ''
+      let finished = false
 
-      while (true) {
+      while (!finished) {
         const { value, done } = await reader.read()
         if (done) break
-        const chunk = decoder.decode(value, { stream: true })
-        if (chunk) {
-          updateAssistantMessage(assistantMessageId, chunk)
+        buffer += decoder.decode(value, { stream: true })
+        const [events, rest] = parseStreamEvents(buffer)
+        buffer = rest
+
+        for (const event of events) {
+          if (event.token) {
+            updateAssistantMessage(assistantMessageId, event.token)
+          }
+          if (event.error) {
+            updateAssistantMessage(assistantMessageId, event.error, true)
+          }
+          if (event.done) {
+            finished = true
+          }
         }
       }
     } catch (err) {